@@ -5,11 +5,22 @@
 
 import datetime
 import psycopg2
+import psycopg2.extras
 import pandas as pd
 import sqlalchemy
 
 import mylogging
 
+# hypertables compressed by compress_chunks, segmented per company
+COMPRESSED_TABLES = ['stocks', 'daystocks']
+
+# continuous aggregates of daystocks: view name -> time_bucket interval
+CONTINUOUS_AGGREGATES = {
+    'daystocks_1w': '1 week',
+    'daystocks_1mo': '1 month',
+    'daystocks_1y': '1 year',
+}
+
 class TimescaleStockMarketModel:
     """ Bourse model with TimeScaleDB persistence."""
 
@@ -36,11 +47,16 @@ class TimescaleStockMarketModel:
                                              password=self.__password)
         self.__engine = sqlalchemy.create_engine(f'timescaledb://{self.__user}:{self.__password}@{self.__host}:{self.__port}/{self.__database}')
         self.__nf_cid = {}  # cid from netfonds symbol
-        self.__boursorama_cid = {}  # cid from netfonds symbol
+        self.__boursorama_cid = {}  # cid from boursorama symbol
+        self.__boursorama_name = {}  # company name from boursorama symbol
         self.__market_id = {}  # id of markets from aliases
 
         self.logger.info("Setup database generates an error if it exists already, it's ok")
         self._setup_database()
+        self._setup_companies_symbol_index()
+        self._setup_compression()
+        self._setup_continuous_aggregates()
+        self._load_companies()
 
 
     def _setup_database(self):
@@ -124,6 +140,92 @@ class TimescaleStockMarketModel:
             self.logger.exception('SQL error: %s' % e)
         self.__connection.commit()
 
+    def _setup_companies_symbol_index(self):
+        '''Unique index on companies symbol, needed by upsert_companies (ON CONFLICT (symbol)).
+        Outside of _setup_database, so that it is also created on databases set up before it.
+        Older analyzers stored SRD names as new companies with an already known symbol:
+        these duplicates are merged first, the smallest id of each symbol is kept (it has the real name)
+        and the stocks and daystocks of the other ids are moved to it.'''
+        try:
+            cursor = self.__connection.cursor()
+            cursor.execute('SELECT count(symbol) - count(DISTINCT symbol) FROM companies;')
+            duplicates = cursor.fetchone()[0]
+            if duplicates > 0:
+                self.logger.info('Merging %d companies with an already known symbol' % duplicates)
+                cursor.execute(
+                    '''CREATE TEMPORARY TABLE duplicate_companies ON COMMIT DROP AS
+                      SELECT id, kept_id FROM (
+                        SELECT id, min(id) OVER (PARTITION BY symbol) AS kept_id FROM companies
+                        WHERE symbol IS NOT NULL
+                      ) ids
+                      WHERE id != kept_id;''')
+                for table in ['stocks', 'daystocks']:
+                    cursor.execute(
+                        f'''UPDATE {table} SET cid = duplicate_companies.kept_id
+                          FROM duplicate_companies WHERE {table}.cid = duplicate_companies.id;''')
+                cursor.execute(
+                    '''DELETE FROM companies USING duplicate_companies
+                      WHERE companies.id = duplicate_companies.id;''')
+            cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_symbol_companies ON companies (symbol);''')
+        except Exception as e:
+            self.logger.exception('SQL error: %s' % e)
+            self.__connection.rollback()
+        self.__connection.commit()
+
+    def _setup_compression(self):
+        '''Enable the compression of stocks and daystocks, per company ordered by date.
+        Outside of _setup_database, so that it also applies to databases set up before it.
+        No compression policy: the analyzer backfills years of history, every chunk would be
+        compressed while it is still written. compress_chunks is called at the end of the analyzer.'''
+        try:
+            cursor = self.__connection.cursor()
+            for table in COMPRESSED_TABLES:
+                cursor.execute(
+                    '''SELECT compression_enabled FROM timescaledb_information.hypertables
+                      WHERE hypertable_name = %s;''', (table,))
+                if not cursor.fetchone()[0]:
+                    cursor.execute(
+                        f'''ALTER TABLE {table} SET (
+                          timescaledb.compress,
+                          timescaledb.compress_segmentby = 'cid',
+                          timescaledb.compress_orderby = 'date DESC'
+                        );''')
+                cursor.execute('SELECT remove_compression_policy(%s, if_exists => true);', (table,))
+        except Exception as e:
+            self.logger.exception('SQL error: %s' % e)
+            self.__connection.rollback()
+        self.__connection.commit()
+
+    def _setup_continuous_aggregates(self):
+        '''Daystocks by week, month and year for the dashboard, filled by refresh_continuous_aggregates.
+        Outside of _setup_database, that stops at its first statement on an existing database:
+        the views are also created on databases set up before them.'''
+        try:
+            cursor = self.__connection.cursor()
+            for view, interval in CONTINUOUS_AGGREGATES.items():
+                cursor.execute(
+                    f'''CREATE MATERIALIZED VIEW IF NOT EXISTS {view} WITH (timescaledb.continuous) AS
+                      SELECT time_bucket('{interval}', date) AS date, cid,
+                        first(open, date) AS open,
+                        max(high) AS high,
+                        min(low) AS low,
+                        last(close, date) AS close,
+                        avg(mean) AS mean
+                      FROM daystocks
+                      GROUP BY time_bucket('{interval}', date), cid
+                      WITH NO DATA;''')
+        except Exception as e:
+            self.logger.exception('SQL error: %s' % e)
+            self.__connection.rollback()
+        self.__connection.commit()
+
+    def _load_companies(self):
+        '''Fill the symbol caches with the companies already in the DB'''
+        # one row per symbol since _setup_companies_symbol_index, else the smallest id is kept, as it does
+        for cid, symbol, name in self.raw_query('SELECT id, symbol, name FROM companies ORDER BY id DESC'):
+            self.__boursorama_cid[symbol] = cid
+            self.__boursorama_name[symbol] = name
+
     # ------------------------------ public methods --------------------------------
 
     def execute(self, query, args=None, cursor=None, commit=False):
@@ -250,6 +352,83 @@ class TimescaleStockMarketModel:
             return res[0][0]
         return 0
 
+    def upsert_companies(self, companies, commit=False):
+        '''
+        Insert companies in one statement, renaming the ones whose symbol is known.
+        A name starting with SRD is not a real rename, it never replaces a name.
+        Only new symbols and real renames are sent to the DB, the others are already in the cache.
+
+        :param companies: list of (name, symbol), at most one per symbol
+        :param commit: do a commit after writing
+        :return: list of (id, symbol) for every given company
+        '''
+        changed = [(name, symbol) for name, symbol in companies
+                   if symbol not in self.__boursorama_cid
+                   or (name != self.__boursorama_name[symbol] and not name.startswith('SRD'))]
+        self.logger.debug('upsert_companies: %d companies, %d new or renamed' % (len(companies), len(changed)))
+        if changed:
+            cursor = self.__connection.cursor()
+            # the CASE always updates the row, so that RETURNING gives every id
+            res = psycopg2.extras.execute_values(
+                cursor,
+                '''INSERT INTO companies (name, symbol) VALUES %s
+                   ON CONFLICT (symbol) DO UPDATE SET name = CASE
+                     WHEN EXCLUDED.name NOT LIKE 'SRD%%' THEN EXCLUDED.name
+                     ELSE companies.name
+                   END
+                   RETURNING id, symbol, name''',
+                changed, fetch=True)
+            if commit:
+                self.commit()
+            for cid, symbol, name in res:
+                self.__boursorama_cid[symbol] = cid
+                self.__boursorama_name[symbol] = name
+        return [(self.__boursorama_cid[symbol], symbol) for _, symbol in companies]
+
+    def batch_insert_file_done(self, files, commit=False):
+        '''
+        Mark a batch of files as included in the DB, in one statement.
+        Files already marked are ignored.
+
+        :param files: list of file names
+        :param commit: do a commit after writing
+        '''
+        self.logger.debug('batch_insert_file_done: %d files' % len(files))
+        cursor = self.__connection.cursor()
+        psycopg2.extras.execute_values(
+            cursor, "INSERT INTO file_done (name) VALUES %s ON CONFLICT DO NOTHING",
+            [(file,) for file in files], page_size=10000)
+        if commit:
+            self.commit()
+
+    def refresh_continuous_aggregates(self):
+        '''
+        Refresh the week, month and year aggregates of daystocks, over all their range.
+        Only the buckets whose daystocks changed since the last refresh are computed again.
+        '''
+        self.commit()
+        # refresh_continuous_aggregate can not run inside a transaction
+        self.__connection.autocommit = True
+        try:
+            cursor = self.__connection.cursor()
+            for view in CONTINUOUS_AGGREGATES:
+                self.logger.debug('refresh_continuous_aggregate: %s' % view)
+                cursor.execute('CALL refresh_continuous_aggregate(%s, NULL, NULL);', (view,))
+        finally:
+            self.__connection.autocommit = False
+
+    def compress_chunks(self):
+        '''
+        Compress the chunks of stocks and daystocks, but the last one of each table:
+        the analyzer writes in date order, the next run may still add rows to it.
+        Chunks already compressed are left as is.
+        '''
+        for table in COMPRESSED_TABLES:
+            self.logger.debug('compress_chunks: %s' % table)
+            self.execute(
+                f'''SELECT compress_chunk(chunk, if_not_compressed => true)
+                  FROM show_chunks('{table}', older_than => (SELECT max(date) FROM {table})) chunk;''')
+        self.commit()
 
     def is_file_done(self, name):
         '''